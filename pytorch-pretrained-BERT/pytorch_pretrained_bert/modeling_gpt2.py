@@ -238,13 +238,16 @@ class Attention(nn.Module):
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
 
-    def _attn(self, q, k, v):
+    def _attn(self, q, k, v, attention_mask=None):
         w = torch.matmul(q, k)
         if self.scale:
             w = w / math.sqrt(v.size(-1))
         nd, ns = w.size(-2), w.size(-1)
         b = self.bias[:, :, ns-nd:ns, :ns]
         w = w * b - 1e4 * (1 - b)
+        if attention_mask is not None:
+            # Apply the (precomputed, additive) padding mask
+            w = w + attention_mask
 
         w = nn.Softmax(dim=-1)(w)
         w = self.attn_dropout(w)
@@ -265,18 +268,35 @@ class Attention(nn.Module):
         else:
             return x.permute(0, 2, 1, 3)  # (batch, head, seq_length, head_features)
 
-    def forward(self, x, layer_past=None):
+    def forward(self, x, layer_past=None, attention_mask=None, past_length=None):
         x = self.c_attn(x)
         query, key, value = x.split(self.split_size, dim=2)
         query = self.split_heads(query)
         key = self.split_heads(key, k=True)
         value = self.split_heads(value)
-        if layer_past is not None:
-            past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
-            key = torch.cat((past_key, key), dim=-1)
-            value = torch.cat((past_value, value), dim=-2)
-        present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
-        a = self._attn(query, key, value)
+        if layer_past is not None and torch.is_tensor(past_length):
+            # Preallocated past with the position on the device (shape-static, e.g. for CUDA graphs): the new keys
+            # and values are written at past_length and the whole buffer is attended, the attention mask hides the
+            # positions which are not filled yet
+            positions = past_length + torch.arange(value.size(-2), device=value.device)
+            layer_past[0].index_copy_(2, positions, key.transpose(-2, -1))
+            layer_past[1].index_copy_(2, positions, value)
+            key, value = layer_past[0].transpose(-2, -1), layer_past[1]
+            present = layer_past
+        elif layer_past is not None and past_length is not None:
+            # Preallocated past: write the new keys and values in place after the first past_length positions
+            end = past_length + value.size(-2)
+            layer_past[0, :, :, past_length:end] = key.transpose(-2, -1)
+            layer_past[1, :, :, past_length:end] = value
+            key, value = layer_past[0, :, :, :end].transpose(-2, -1), layer_past[1, :, :, :end]
+            present = layer_past
+        else:
+            if layer_past is not None:
+                past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]  # transpose back cf below
+                key = torch.cat((past_key, key), dim=-1)
+                value = torch.cat((past_value, value), dim=-2)
+            present = torch.stack((key.transpose(-2, -1), value))  # transpose to have same shapes for stacking
+        a = self._attn(query, key, value, attention_mask)
         if self.output_attentions:
             attentions, a = a
         a = self.merge_heads(a)
@@ -312,8 +332,8 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(nx, eps=config.layer_norm_epsilon)
         self.mlp = MLP(4 * nx, config)
 
-    def forward(self, x, layer_past=None):
-        output_attn = self.attn(self.ln_1(x), layer_past=layer_past)
+    def forward(self, x, layer_past=None, attention_mask=None, past_length=None):
+        output_attn = self.attn(self.ln_1(x), layer_past=layer_past, attention_mask=attention_mask, past_length=past_length)
         if self.output_attentions:
             attentions, a, present = output_attn
         else:
@@ -561,6 +581,15 @@ class GPT2Model(GPT2PreTrainedModel):
         `past`: an optional list of torch.LongTensor that contains pre-computed hidden-states
             (key and values in the attention blocks) to speed up sequential decoding
             (this is the presents output of the model, cf. below).
+        `attention_mask`: an optional torch.LongTensor of shape [batch_size, past_length + sequence_length]
+            with indices selected in [0, 1]. Positions set to 0 (e.g. left padding of a batch of sequences with
+            varying lengths) are not attended to. It covers the `past` positions as well as the new inputs.
+        `past_length`: an optional int to use `past` as a preallocated buffer (cf. `GPT2Model.init_past`) whose
+            first `past_length` positions are filled. The new keys and values are written in place after them,
+            and `presents` are the `past` buffers themselves.
+            `past_length` can also be a torch.LongTensor of shape [1] on the device for a single new position (e.g. to
+            capture a decoding step in a CUDA graph): the whole buffer is then attended and `attention_mask` of shape
+            [batch_size, buffer length] must mask the positions which are not filled yet (they must hold finite values).
 
     Outputs a tuple consisting of:
         `hidden_states`: the encoded-hidden-states at the top of the model
@@ -607,14 +636,23 @@ class GPT2Model(GPT2PreTrainedModel):
         # Copy word embeddings from the previous weights
         self.wte.weight.data[:self.config.vocab_size, :] = old_embed.weight.data[:self.config.vocab_size, :]
 
-    def forward(self, input_ids, position_ids=None, token_type_ids=None, past=None):
+    def init_past(self, batch_size, max_length):
+        """ Allocate an empty `past` for up to max_length positions, to be filled in place with `past_length` """
+        head_features = self.config.n_embd // self.config.n_head
+        return [self.wte.weight.new_empty(2, batch_size, self.config.n_head, max_length, head_features)
+                for _ in self.h]
+
+    def forward(self, input_ids, position_ids=None, token_type_ids=None, past=None, attention_mask=None,
+                past_length=None):
+        # A preallocated past is filled in place by the attention blocks after its first past_length positions
+        fill_length = past_length if past is not None else None
         if past is None:
             past_length = 0
             past = [None] * len(self.h)
-        else:
+        elif past_length is None:
             past_length = past[0][0].size(-2)
         if position_ids is None:
-            position_ids = torch.arange(past_length, input_ids.size(-1) + past_length, dtype=torch.long, device=input_ids.device)
+            position_ids = past_length + torch.arange(input_ids.size(-1), dtype=torch.long, device=input_ids.device)
             position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
 
         input_shape = input_ids.size()
@@ -631,14 +669,21 @@ class GPT2Model(GPT2PreTrainedModel):
         hidden_states = inputs_embeds + position_embeds + token_type_embeds
         hidden_states = self.drop(hidden_states)
 
+        if attention_mask is not None:
+            # We create a 4D additive mask [batch_size, 1, 1, past_length + sequence_length] from the 2D mask
+            # which broadcasts over the heads and the query positions (cf. BertModel).
+            attention_mask = attention_mask.view(-1, attention_mask.size(-1)).unsqueeze(1).unsqueeze(2)
+            attention_mask = attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
+            attention_mask = (1.0 - attention_mask) * -10000.0
+
         presents = []
         all_attentions = []
         for block, layer_past in zip(self.h, past):
             if self.output_attentions:
-                attentions, hidden_states, present = block(hidden_states, layer_past)
+                attentions, hidden_states, present = block(hidden_states, layer_past, attention_mask, fill_length)
                 all_attentions.append(attentions)
             else:
-                hidden_states, present = block(hidden_states, layer_past)
+                hidden_states, present = block(hidden_states, layer_past, attention_mask, fill_length)
             presents.append(present)
         hidden_states = self.ln_f(hidden_states)
         output_shape = input_shape + (hidden_states.size(-1),)
@@ -669,6 +714,15 @@ class GPT2LMHeadModel(GPT2PreTrainedModel):
         `past`: an optional list of torch.LongTensor that contains pre-computed hidden-states
             (key and values in the attention blocks) to speed up sequential decoding
             (this is the presents output of the model, cf. below).
+        `attention_mask`: an optional torch.LongTensor of shape [batch_size, past_length + sequence_length]
+            with indices selected in [0, 1]. Positions set to 0 (e.g. left padding of a batch of sequences with
+            varying lengths) are not attended to. It covers the `past` positions as well as the new inputs.
+        `past_length`: an optional int to use `past` as a preallocated buffer (cf. `GPT2Model.init_past`) whose
+            first `past_length` positions are filled. The new keys and values are written in place after them,
+            and `presents` are the `past` buffers themselves.
+            `past_length` can also be a torch.LongTensor of shape [1] on the device for a single new position (e.g. to
+            capture a decoding step in a CUDA graph): the whole buffer is then attended and `attention_mask` of shape
+            [batch_size, buffer length] must mask the positions which are not filled yet (they must hold finite values).
 
     Outputs:
         if `lm_labels` is not `None`:
@@ -705,8 +759,13 @@ class GPT2LMHeadModel(GPT2PreTrainedModel):
         self.transformer.set_num_special_tokens(num_special_tokens)
         self.lm_head.set_embeddings_weights(self.transformer.wte.weight, predict_special_tokens=predict_special_tokens)
 
-    def forward(self, input_ids, lm_labels=None, token_type_ids=None, position_ids=None, past=None):
-        transformer_output = self.transformer(input_ids, position_ids, token_type_ids, past)
+    def init_past(self, batch_size, max_length):
+        """ Allocate an empty `past` for up to max_length positions (cf. `GPT2Model.init_past`) """
+        return self.transformer.init_past(batch_size, max_length)
+
+    def forward(self, input_ids, lm_labels=None, token_type_ids=None, position_ids=None, past=None, attention_mask=None,
+                past_length=None):
+        transformer_output = self.transformer(input_ids, position_ids, token_type_ids, past, attention_mask, past_length)
         if self.transformer.output_attentions:
             all_attentions, hidden_states, presents = transformer_output
         else:
@@ -752,6 +811,15 @@ class GPT2DoubleHeadsModel(GPT2PreTrainedModel):
         `past`: an optional list of torch.LongTensor that contains pre-computed hidden-states
             (key and values in the attention blocks) to speed up sequential decoding
             (this is the presents output of the model, cf. below).
+        `attention_mask`: an optional torch.LongTensor of shape [batch_size, past_length + sequence_length]
+            with indices selected in [0, 1]. Positions set to 0 (e.g. left padding of a batch of sequences with
+            varying lengths) are not attended to. It covers the `past` positions as well as the new inputs.
+        `past_length`: an optional int to use `past` as a preallocated buffer (cf. `GPT2Model.init_past`) whose
+            first `past_length` positions are filled. The new keys and values are written in place after them,
+            and `presents` are the `past` buffers themselves.
+            `past_length` can also be a torch.LongTensor of shape [1] on the device for a single new position (e.g. to
+            capture a decoding step in a CUDA graph): the whole buffer is then attended and `attention_mask` of shape
+            [batch_size, buffer length] must mask the positions which are not filled yet (they must hold finite values).
 
     Outputs:
         if `lm_labels` and `multiple_choice_labels` are not `None`:
@@ -790,8 +858,9 @@ class GPT2DoubleHeadsModel(GPT2PreTrainedModel):
         self.transformer.set_num_special_tokens(num_special_tokens)
         self.lm_head.set_embeddings_weights(self.transformer.wte.weight, predict_special_tokens=predict_special_tokens)
 
-    def forward(self, input_ids, mc_token_ids, lm_labels=None, mc_labels=None, token_type_ids=None, position_ids=None, past=None):
-        transformer_output = self.transformer(input_ids, position_ids, token_type_ids, past)
+    def forward(self, input_ids, mc_token_ids, lm_labels=None, mc_labels=None, token_type_ids=None, position_ids=None, past=None,
+                attention_mask=None, past_length=None):
+        transformer_output = self.transformer(input_ids, position_ids, token_type_ids, past, attention_mask, past_length)
         if self.transformer.output_attentions:
             all_attentions, hidden_states, presents = transformer_output
         else:
@@ -191,6 +191,53 @@ class GPT2ModelTest(unittest.TestCase):
         os.remove(json_file_path)
         self.assertEqual(config_second.to_dict(), config_first.to_dict())
 
+    def test_attention_mask_left_padding(self):
+        config = GPT2Config(vocab_size_or_config_json_file=99, n_positions=33, n_embd=32, n_layer=2, n_head=4)
+        model = GPT2LMHeadModel(config)
+        model.eval()
+        input_ids = GPT2ModelTest.ids_tensor([1, 5], 99)
+        next_ids = GPT2ModelTest.ids_tensor([1, 1], 99)
+        lm_logits, presents = model(input_ids)
+        next_logits, _ = model(next_ids, past=presents)
+
+        # The same sequence left padded with 3 masked tokens should give the same logits
+        padded_ids = torch.cat((torch.zeros(1, 3, dtype=torch.long), input_ids), dim=-1)
+        attention_mask = torch.cat((torch.zeros(1, 3, dtype=torch.long), torch.ones(1, 5, dtype=torch.long)), dim=-1)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        padded_logits, padded_presents = model(padded_ids, position_ids=position_ids, attention_mask=attention_mask)
+        self.assertTrue(torch.allclose(lm_logits, padded_logits[:, 3:], atol=1e-4))
+
+        attention_mask = torch.cat((attention_mask, torch.ones(1, 1, dtype=torch.long)), dim=-1)
+        padded_next_logits, _ = model(next_ids, position_ids=torch.tensor([[5]]), past=padded_presents,
+                                      attention_mask=attention_mask)
+        self.assertTrue(torch.allclose(next_logits, padded_next_logits, atol=1e-4))
+
+    def test_preallocated_past(self):
+        config = GPT2Config(vocab_size_or_config_json_file=99, n_positions=33, n_embd=32, n_layer=2, n_head=4)
+        model = GPT2LMHeadModel(config)
+        model.eval()
+        input_ids = GPT2ModelTest.ids_tensor([2, 5], 99)
+        next_ids = GPT2ModelTest.ids_tensor([2, 1], 99)
+        lm_logits, presents = model(input_ids)
+        next_logits, _ = model(next_ids, past=presents)
+
+        # Decoding with a preallocated past filled in place should give the same logits
+        past = model.transformer.init_past(2, 8)
+        self.assertListEqual(list(past[0].size()), [2, 2, 4, 8, 8])
+        prealloc_logits, prealloc_presents = model(input_ids, past=past, past_length=0)
+        self.assertTrue(torch.allclose(lm_logits, prealloc_logits, atol=1e-4))
+        self.assertIs(prealloc_presents[0], past[0])
+        prealloc_next_logits, _ = model(next_ids, past=past, past_length=5)
+        self.assertTrue(torch.allclose(next_logits, prealloc_next_logits, atol=1e-4))
+
+        # With past_length on the device the whole buffer is attended, the unfilled positions are masked
+        past = [p.zero_() for p in model.transformer.init_past(2, 8)]
+        model(input_ids, past=past, past_length=0)
+        attention_mask = torch.tensor([[1] * 6 + [0] * 2] * 2)
+        device_next_logits, _ = model(next_ids, past=past, attention_mask=attention_mask,
+                                      past_length=torch.tensor([5]))
+        self.assertTrue(torch.allclose(next_logits, device_next_logits, atol=1e-4))
+
     @pytest.mark.slow
     def test_model_from_pretrained(self):
         cache_dir = "/tmp/pytorch_pretrained_bert_test/"
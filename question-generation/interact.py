@@ -2,100 +2,326 @@
 # All rights reserved.
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
+import os
 import json
 import logging
 import random
 import tqdm
 from argparse import ArgumentParser
-from itertools import chain
+from itertools import chain, groupby
 from pprint import pformat
-import copy
 import torch
 import torch.nn.functional as F
 
 from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer, GPT2LMHeadModel, GPT2Tokenizer
 from train import SPECIAL_TOKENS, build_input_from_segments
 from dataloader import get_dataset_from_file
+from onnx_model import OnnxGPT2LMHeadModel, export_onnx
 
+STOP_CHECK_INTERVAL = 8  # Number of decoding steps between two checks (GPU synchronizations) of the finished questions
+CUDA_GRAPH_LENGTH_MULTIPLE = 64  # The buffers decoded with --cuda_graph are padded to a multiple of this length
 
-def top_filtering(logits, top_k=0, top_p=0.0, threshold=-float('Inf'), filter_value=-float('Inf')):
-    """ Filter a distribution of logits using top-k, top-p (nucleus) and/or threshold filtering
+# inference_mode also skips the version counters and view tracking of no_grad, it is only available from torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def filter_candidates(logits, top_k=0, top_p=0.0, threshold=-float('Inf'), filter_value=-float('Inf'), top_p_prefix=1024):
+    """ Select the candidate tokens of a batch of logits distributions with top-k, top-p (nucleus) and/or threshold
+        filtering.
         Args:
-            logits: logits distribution shape (vocabulary size)
+            logits: logits distribution shape (vocabulary size) or (batch size, vocabulary size)
             top_k: <=0: no filtering, >0: keep only top k tokens with highest probability.
             top_p: <=0.0: no filtering, >0.0: keep only a subset S of candidates, where S is the smallest subset
                 whose total probability mass is greater than or equal to the threshold top_p.
                 In practice, we select the highest probability tokens whose cumulative probability mass exceeds
                 the threshold top_p.
             threshold: a minimal threshold to keep logits
+            top_p_prefix: number of most likely tokens sorted for top-p filtering (without top-k), the nucleus is
+                truncated to them when they do not reach the top_p probability mass.
+        Returns a tuple (candidate_logits, candidate_indices) with the logits of the most likely tokens sorted by
+        decreasing value, the filtered ones being set to filter_value, and their indices in the vocabulary.
+        Without top-k and top-p filtering every token is a candidate: the logits are returned as is with indices None.
     """
-    assert logits.dim() == 1  # Only work for batch size 1 for now - could update but it would obfuscate a bit the code
     top_k = min(top_k, logits.size(-1))
+    if top_k <= 0 and top_p <= 0.0:
+        if threshold == -float('Inf'):
+            return logits, None
+        return logits.masked_fill(logits < threshold, filter_value), None
+
     if top_k > 0:
-        # Remove all tokens with a probability less than the last token in the top-k tokens
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        # Keep only the top-k tokens (sorted by torch.topk), the nucleus is searched among them
+        sorted_logits, sorted_indices = torch.topk(logits, top_k)
+        if top_p > 0.0:
+            sorted_probabilities = F.softmax(sorted_logits, dim=-1)
+    else:
+        # The nucleus is searched among the top_p_prefix most likely tokens instead of sorting the whole vocabulary.
+        # A flatter distribution is truncated to this prefix (no host-side check, it would synchronize every step)
+        probabilities = F.softmax(logits, dim=-1)
+        sorted_probabilities, sorted_indices = torch.topk(probabilities, min(top_p_prefix, logits.size(-1)))
+        sorted_logits = logits.gather(-1, sorted_indices)
 
+    sorted_indices_to_remove = sorted_logits < threshold
     if top_p > 0.0:
-        # Compute cumulative probabilities of sorted tokens
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probabilities = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
         # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probabilities > top_p
+        cumulative_probabilities = torch.cumsum(sorted_probabilities, dim=-1)
+        above_top_p = cumulative_probabilities > top_p
         # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
+        above_top_p[..., 1:] = above_top_p[..., :-1].clone()
+        above_top_p[..., 0] = 0
+        sorted_indices_to_remove = sorted_indices_to_remove | above_top_p
 
-        # Back to unsorted indices and set them to -infinity
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
+    return sorted_logits.masked_fill(sorted_indices_to_remove, filter_value), sorted_indices
 
-    indices_to_remove = logits < threshold
-    logits[indices_to_remove] = filter_value
 
+def sample_next_tokens(logits, args):
+    """ Sample one token per row of temperature scaled `logits` (batch size, vocabulary size) with top-k/top-p filtering.
+        With `--fused_sampling`, filtering, softmax and sampling run in a single FlashInfer kernel.
+        Otherwise the token is sampled among the sorted candidates, without going back to the whole vocabulary.
+    """
+    if args.fused_sampling:
+        from flashinfer.sampling import top_k_top_p_sampling_from_logits  # FlashInfer is only required for fused sampling
+        top_k = args.top_k if args.top_k > 0 else logits.size(-1)
+        top_p = args.top_p if args.top_p > 0.0 else 1.0
+        return top_k_top_p_sampling_from_logits(logits, top_k, top_p).long().unsqueeze(-1)
+
+    candidate_logits, candidate_indices = filter_candidates(logits, top_k=args.top_k, top_p=args.top_p)
+    # Gumbel-max trick: the argmax of logits perturbed with Gumbel noise is a sample from softmax(logits)
+    gumbel_noise = -torch.log(-torch.log(torch.rand_like(candidate_logits).clamp_(min=1e-20)))
+    prev = torch.argmax(candidate_logits + gumbel_noise, dim=-1, keepdim=True)
+    return prev if candidate_indices is None else candidate_indices.gather(-1, prev)
+
+
+def build_prefix_and_prompt(inst, tokenizer):
+    """ Split the decoding input of an instance in two parts:
+        1. the paragraph prefix `<bos> .. paragraph text ..`, shared by all the questions of the paragraph,
+        2. the answer prompt `<answer-general> .. answer span .. <question-general>` (or specific).
+    """
+    instance, _ = build_input_from_segments(dict(inst, question=[]), tokenizer, with_eos=False)
+    para_len = len(inst['paragraph']) + 1
+    prefix, prompt = {}, {}
+    for name in ["input_ids", "token_type_ids"]:
+        prefix[name] = instance[name][:para_len]
+        prompt[name] = instance[name][para_len:]
+    return prefix, prompt
+
+
+def pad_left(sequences, pad, device):
+    """ Left pad the `input_ids` and `token_type_ids` of a list of sequences to the same length.
+        Returns the padded input_ids, token_type_ids and the attention mask (0 on the padding) as tensors on device.
+    """
+    max_l = max(len(x['input_ids']) for x in sequences)
+    input_ids, token_type_ids, attention_mask = [], [], []
+    for sequence in sequences:
+        padding = max_l - len(sequence['input_ids'])
+        input_ids.append([pad] * padding + sequence['input_ids'])
+        token_type_ids.append([pad] * padding + sequence['token_type_ids'])
+        attention_mask.append([0] * padding + [1] * len(sequence['input_ids']))
+    return (torch.tensor(input_ids, device=device), torch.tensor(token_type_ids, device=device),
+            torch.tensor(attention_mask, device=device))
+
+
+def decode_step(model, prev, token_type_ids, position_ids, past, attention_mask, cache_position):
+    """ Run one decoding step on the full-length `attention_mask` with the next position of the preallocated `past`
+        kept on the device (`cache_position`), all the inputs are updated in place for the next step.
+    """
+    attention_mask.index_fill_(1, cache_position, 1)
+    logits, _ = model(prev, token_type_ids=token_type_ids, position_ids=position_ids, past=past,
+                      attention_mask=attention_mask, past_length=cache_position)
+    cache_position += 1
+    position_ids += 1
     return logits
 
 
-def sample_sequence(inst, tokenizer, model, args,past):
-    special_tokens_ids = tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
-    inst['original_question'] = inst['question']
-    inst['question'] = []
-    inst['orig_paragraph'] = inst['paragraph']
-    inst['paragraph'] = []
-    instance, _ = build_input_from_segments(inst, tokenizer, with_eos=False)
-    input_ids = torch.tensor(instance['input_ids'][1:],device=args.device).unsqueeze(0) #remove extra eos
-    token_type_ids = torch.tensor(instance['token_type_ids'][1:],device=args.device).unsqueeze(0)
-    inst['original_context'] = instance['input_ids']
-    logits, past = model(input_ids, token_type_ids=token_type_ids,past=past)
-    token_type = instance['token_type_ids'][-1]
+def capture_decode_step(model, prev, token_type_ids, position_ids, past, attention_mask, cache_position):
+    """ Capture `decode_step` in a CUDA graph. Replaying the graph runs the step on the same input tensors, which
+        are updated in place, and returns its logits in the same output tensor.
+    """
+    # Warm up on a side stream before the capture. The decoding state is restored afterwards, the keys/values written
+    # at the current position are overwritten by the first replay
+    state = [position_ids.clone(), cache_position.clone()]
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        decode_step(model, prev, token_type_ids, position_ids, past, attention_mask, cache_position)
+    torch.cuda.current_stream().wait_stream(stream)
+    for tensor, saved in zip([position_ids, cache_position], state):
+        tensor.copy_(saved)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        logits = decode_step(model, prev, token_type_ids, position_ids, past, attention_mask, cache_position)
+    return graph, logits
+
+
+class DecodeGraphs(object):
+    """ CUDA graphs of the decoding step (`decode_step`), captured once per (batch size, padded buffer length) and
+        replayed for all the batches of this shape, across paragraphs. The decoding state (past, attention mask and
+        inputs of the step) lives in static buffers of `max_batch_size` rows shared by all the graphs, a batch uses
+        views of its first rows and positions.
+    """
 
-    for i in range(args.max_length):
-        #instance, _ = build_input_from_segments(inst, tokenizer, with_eos=False)
+    def __init__(self, model, max_batch_size):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.length = 0
+        self.graphs = {}
+
+    def buffers(self, batch_size, length):
+        """ Select the shape of the next batch and return views of the static `past` and attention mask for it.
+            `length` is padded to a multiple of CUDA_GRAPH_LENGTH_MULTIPLE.
+        """
+        length = -(-length // CUDA_GRAPH_LENGTH_MULTIPLE) * CUDA_GRAPH_LENGTH_MULTIPLE
+        length = min(length, self.model.config.n_positions)
+        if length > self.length:
+            # Grow the static buffers, the graphs captured on the previous ones are dropped. The positions which are
+            # not filled are masked out and must hold finite values: the past starts zeroed
+            self.length, self.graphs = length, {}
+            self.past = [p.zero_() for p in self.model.init_past(self.max_batch_size, length)]
+            self.attention_mask = torch.zeros(self.max_batch_size, length, dtype=torch.long, device=self.past[0].device)
+            self.inputs = self.attention_mask.new_zeros(3, self.max_batch_size, 1)  # prev, token_type_ids, position_ids
+            self.cache_position = self.attention_mask.new_zeros(1)
+        self.shape = (batch_size, length)
+        return [p[:, :batch_size, :, :length] for p in self.past], self.attention_mask[:batch_size, :length]
+
+    def start(self, token_type_ids, position_ids, cache_position):
+        """ Set the inputs of the first decoding step of the batch, `cache_position` is its position in the past """
+        batch_size = self.shape[0]
+        self.inputs[1, :batch_size] = token_type_ids
+        self.inputs[2, :batch_size] = position_ids
+        self.cache_position.fill_(cache_position)
+
+    def step(self, prev):
+        """ Run a decoding step of the batch on the tokens `prev`, the graph of its shape is captured at first use """
+        batch_size, length = self.shape
+        self.inputs[0, :batch_size] = prev
+        if self.shape not in self.graphs:
+            prev, token_type_ids, position_ids = self.inputs[:, :batch_size]
+            past = [p[:, :batch_size, :, :length] for p in self.past]
+            self.graphs[self.shape] = capture_decode_step(self.model, prev, token_type_ids, position_ids, past,
+                                                          self.attention_mask[:batch_size, :length], self.cache_position)
+        graph, logits = self.graphs[self.shape]
+        graph.replay()
+        return logits
+
+
+def sample_sequence(insts, tokenizer, model, args, past, special_tokens_ids, pad, graphs=None):
+    """ Generate the questions of a bucket of instances sharing the same paragraph.
+        The paragraph `past` (batch size 1) is copied in a preallocated batch `past` so that only the answer
+        prompts are fed to the model, then each decoding step runs a single forward pass over the instances which
+        have not produced a special token yet.
+        With `graphs` (a DecodeGraphs, `--cuda_graph`), the decoding step is replayed from a CUDA graph on the whole
+        batch (finished rows are not compacted away).
+        The answer prompts have different lengths, they are left padded and the padding is masked out.
+        `past` is not modified and can be reused for the other questions of the paragraph.
+        `special_tokens_ids` is a tensor of the special token ids on `args.device` and `pad` the padding token id.
+    """
+
+    prompts = []
+    for inst in insts:
+        inst['original_question'] = inst['question']
+        _, prompt = build_prefix_and_prompt(inst, tokenizer)
+        prompts.append(prompt)
+
+    batch_size = len(insts)
+    input_ids, token_type_ids, attention_mask = pad_left(prompts, pad, args.device)
+    max_l = input_ids.size(-1)
+
+    # Padded positions get the position of the first real token, they are never attended to
+    past_length = past[0].size(-2)
+    position_ids = past_length + (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    # The attention mask and the keys/values (past) are allocated once for the whole generation, the model writes
+    # the keys/values of each step in place and each step attends to a growing slice of them
+    context_length = past_length + max_l
+    prompt_mask, paragraph_past = attention_mask, past
+    if graphs is None:
+        attention_mask = prompt_mask.new_ones(batch_size, context_length + args.max_length)
+        past = model.init_past(batch_size, context_length + args.max_length)
+    else:
+        # The static buffers of the CUDA graphs attend to all their positions, the ones which are not generated yet
+        # are masked out
+        past, attention_mask = graphs.buffers(batch_size, context_length + args.max_length)
+        attention_mask.fill_(1)
+        attention_mask[:, context_length:] = 0
+    attention_mask[:, past_length:context_length] = prompt_mask
+    for buffer, paragraph_buffer in zip(past, paragraph_past):
+        buffer[:, :, :, :past_length] = paragraph_buffer
+
+    logits, past = model(input_ids, token_type_ids=token_type_ids, position_ids=position_ids, past=past,
+                         attention_mask=attention_mask[:, :context_length], past_length=past_length)
+    token_type_ids = token_type_ids[:, -1:].contiguous()
+    position_ids = position_ids[:, -1:] + 1
+
+    if graphs is not None:
+        graphs.start(token_type_ids, position_ids, context_length)
+
+    # Rows of the current batch are the instances `active`. The stopping decisions stay on the device: a finished row
+    # keeps being decoded (its tokens are discarded) until the batch is compacted every STOP_CHECK_INTERVAL steps
+    active = torch.arange(batch_size, device=args.device)
+    questions = torch.full((batch_size, args.max_length), pad, dtype=torch.long, device=args.device)
+    lengths = torch.full((batch_size,), args.max_length, dtype=torch.long, device=args.device)
 
-        #input_ids = torch.tensor(instance["input_ids"], device=args.device).unsqueeze(0)
-        #token_type_ids = torch.tensor(instance["token_type_ids"], device=args.device).unsqueeze(0)
+    for i in range(args.max_length):
+        logits = logits[:, -1, :].float() / args.temperature  # filtering and sampling stay in fp32 with --fp16
+        if i < args.min_length:
+            # Special tokens (which end the question) cannot be generated before min_length
+            logits.index_fill_(-1, special_tokens_ids, -float('Inf'))
+        prev = torch.topk(logits, 1)[1] if args.no_sample else sample_next_tokens(logits, args)
+
+        questions[active, i] = prev.squeeze(-1)
+        finished = (prev == special_tokens_ids).any(-1) & (lengths[active] == args.max_length)
+        lengths[active] = lengths[active].masked_fill(finished, i)
+
+        if (i + 1) % STOP_CHECK_INTERVAL == 0:
+            # Only keep decoding the unfinished rows
+            keep = (lengths[active] == args.max_length).nonzero().squeeze(-1)
+            if keep.size(0) == 0:
+                break
+            if keep.size(0) < active.size(0) and graphs is None:  # a CUDA graph decodes a fixed batch
+                active, prev = active[keep], prev[keep]
+                token_type_ids, position_ids, attention_mask = token_type_ids[keep], position_ids[keep], attention_mask[keep]
+                past = [p.index_select(1, keep) for p in past]
+
+        if graphs is not None:
+            logits = graphs.step(prev)
+        else:
+            logits, past = model(prev, token_type_ids=token_type_ids, position_ids=position_ids, past=past,
+                                 attention_mask=attention_mask[:, :context_length + i + 1], past_length=context_length + i)
+            position_ids += 1
 
-        
+    for inst, question, length in zip(insts, questions.tolist(), lengths.tolist()):
+        inst['question'] = question[:length]
+    return insts
 
-        logits = logits[0, -1, :] / args.temperature
-        logits = top_filtering(logits, top_k=args.top_k, top_p=args.top_p)
-        probs = F.softmax(logits, dim=-1)
 
-        prev = torch.topk(probs, 1)[1] if args.no_sample else torch.multinomial(probs, 1)
-        if i < args.min_length and prev.item() in special_tokens_ids:
-            while prev.item() in special_tokens_ids:
-                prev = torch.multinomial(probs, num_samples=1)
+def write_paragraph(f, outputs, tokenizer, question_number):
+    """ Write the SQUAD-like paragraph of the generated questions `outputs` of one para_index, numbered from
+        question_number (the first paragraph of the file has question 0). Their paragraphs may be truncated
+        differently, the longest one is the context. Returns the next question number.
+    """
+    paragraph = {
+        'context': tokenizer.decode(max((output['paragraph'] for output in outputs), key=len)),
+        'qas': []
+    }
+    for output in outputs:
+        generated_question = tokenizer.decode(output['question'], skip_special_tokens=True)
+        original_answer = tokenizer.decode(output['answer'], skip_special_tokens=True)
 
-        if prev.item() in special_tokens_ids:
-            break
+        # append the question answer pair
+        paragraph['qas'].append({
+            'id': 'question_%d' % (question_number + len(paragraph['qas'])),
+            'question': generated_question,
+            'answers': [{
+                'text': original_answer,
+                'answer_start': paragraph['context'].index(original_answer)
+            }],
+            'class': output['class'],
+            'algorithm': output['algorithm'],
+            'is_impossible': False
+        })
 
-        input_ids = prev.unsqueeze(0)
-        token_type_ids = torch.tensor([token_type]).unsqueeze(0)
-        logits, past = model(input_ids, token_type_ids=token_type_ids,past=past)   
-        inst['question'].append(prev.item())
-    inst['paragraph'] = inst['orig_paragraph']
-    return inst
+    f.write((", " if question_number > 0 else "") + json.dumps(paragraph))
+    return question_number + len(outputs)
 
 
 def run():
@@ -111,7 +337,23 @@ def run():
     parser.add_argument("--temperature", type=int, default=0.7, help="Sampling softmax temperature")
     parser.add_argument("--top_k", type=int, default=0, help="Filter top-k tokens before sampling (<=0: no filtering)")
     parser.add_argument("--top_p", type=float, default=0.9, help="Nucleus filtering (top-p) before sampling (<=0.0: no filtering)")
+    parser.add_argument("--fp16", action='store_true', help="Set to run the model in half precision (CUDA only)")
+    parser.add_argument("--fused_sampling", action='store_true', help="Set to sample with a fused FlashInfer kernel (CUDA only)")
+    parser.add_argument("--cuda_graph", action='store_true', help="Set to replay the decoding steps from CUDA graphs "
+                        "captured once per batch shape (CUDA only)")
+    parser.add_argument("--prefill_batch_size", type=int, default=8, help="Number of paragraphs prefilled together")
+    parser.add_argument("--onnx_model", type=str, default="", help="Path of an ONNX export of the model (created if missing) "
+                        "to decode with ONNX Runtime (gpt2 only, the export requires torch >= 1.2)")
+    parser.add_argument("--batch_size", type=int, default=16, help="Maximum number of questions of a paragraph decoded together")
     args = parser.parse_args()
+    if torch.device(args.device).type != 'cuda':
+        for flag in ['fp16', 'fused_sampling', 'cuda_graph']:
+            if getattr(args, flag):
+                parser.error("--%s requires a CUDA device" % flag)
+    if args.cuda_graph and args.onnx_model:
+        parser.error("--cuda_graph decodes with the PyTorch model, it cannot be used with --onnx_model")
+    if args.onnx_model and args.model_type != 'gpt2':
+        parser.error("--onnx_model is only available for --model_type gpt2")
 
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__file__)
@@ -131,78 +373,68 @@ def run():
         model = OpenAIGPTLMHeadModel.from_pretrained(args.model_checkpoint)
 
     model.to(args.device)
+    if args.fp16:
+        model.half()
     model.eval()
 
+    if args.onnx_model:
+        if not os.path.isfile(args.onnx_model):
+            export_onnx(model, args.onnx_model, args.device)
+        logger.info("Decode with ONNX Runtime from %s", args.onnx_model)
+        # The PyTorch weights are released, only the config is needed to allocate the past buffers
+        model = OnnxGPT2LMHeadModel(args.onnx_model, model.config, args.device,
+                                    dtype=torch.float16 if args.fp16 else torch.float32)
+
+    special_tokens_ids = tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
+    pad = special_tokens_ids[-1]
+    special_tokens_ids = torch.tensor(special_tokens_ids, device=args.device)
+    graphs = DecodeGraphs(model, args.batch_size) if args.cuda_graph else None
+
     data = get_dataset_from_file(tokenizer, args.filename)
-    final_output_dict = {
-        "version": "squash-2.0",
-        "data": [{
-            "paragraphs": []
-        }]
-    }
+    # Group the questions of each paragraph (the sort is stable, questions keep their order within a paragraph)
+    data = sorted(data, key=lambda x: x['para_index'])
     question_number = 0
-    prev_para_index = None
-    past =None
-
-    for inst in tqdm.tqdm(data):
-        with torch.no_grad():
-            para_index = inst['para_index']
-            if para_index != prev_para_index:
-                past  = None
-                instance1 = copy.deepcopy(inst)
-                instance1['question'] = []
-                instance1['ori_answer'] = instance1['answer']
-                instance1['answer'] = []
-                instance, _ = build_input_from_segments(inst, tokenizer, with_eos=False)
-                input_ids = torch.tensor(instance['input_ids'][:-2],device=args.device).unsqueeze(0) #remove extra eos
-                token_type_ids = torch.tensor(instance['token_type_ids'][:-2],device=args.device).unsqueeze(0)
-                _ , past = model(input_ids, token_type_ids=token_type_ids,past=past)
-
-            output = sample_sequence(inst, tokenizer, model, args,past)
-
-        original_paragraph = tokenizer.decode(output['paragraph'])
-        generated_question = tokenizer.decode(output['question'], skip_special_tokens=True)
-        original_answer = tokenizer.decode(output['answer'], skip_special_tokens=True)
-        para_index = inst['para_index']
-        prev_para_index = inst['para_index']
-
-        # Output in a SQUAD-like format with questions clumped together under their parent paragraph
-        if len(final_output_dict["data"][0]["paragraphs"]) > para_index:
-            # verify whether the paragraph text is identical
-            assert original_paragraph == final_output_dict["data"][0]["paragraphs"][para_index]['context']
-            # append the question answer pair
-            final_output_dict["data"][0]["paragraphs"][para_index]['qas'].append({
-                'id': 'question_%d' % question_number,
-                'question': generated_question,
-                'answers': [{
-                    'text': original_answer,
-                    'answer_start': original_paragraph.index(original_answer)
-                }],
-                'class': output['class'],
-                'algorithm': output['algorithm'],
-                'is_impossible': False
-            })
-        else:
-            # add a new question to the list of QA pairs
-            final_output_dict['data'][0]['paragraphs'].append({
-                'context': original_paragraph,
-                'qas': [{
-                    'id': 'question_%d' % question_number,
-                    'question': generated_question,
-                    'answers': [{
-                        'text': original_answer,
-                        'answer_start': original_paragraph.index(original_answer)
-                    }],
-                    'class': output['class'],
-                    'algorithm': output['algorithm'],
-                    'is_impossible': False
-                }]
-            })
-
-        question_number += 1
-
-    with open("squash/temp/generated_questions.json", "w") as f:
-        f.write(json.dumps(final_output_dict))
+
+    # Output in a SQUAD-like format with questions clumped together under their parent paragraph.
+    # The output is written paragraph by paragraph instead of building the whole dictionary in memory, in a temporary
+    # file which only replaces the previous output once complete (a failed run leaves the previous output untouched).
+    output_path = "squash/temp/generated_questions.json"
+    with open(output_path + ".tmp", "w") as f:
+        f.write('{"version": "squash-2.0", "data": [{"paragraphs": [')
+
+        # Questions of a paragraph share the paragraph prefix and are decoded together. Paragraphs are truncated per
+        # instance, so the questions are bucketed by their actual paragraph tokens (a para_index may have several
+        # buckets). The paragraph prefixes are left padded and prefilled by groups of prefill_batch_size buckets
+        buckets = [list(bucket) for _, bucket in groupby(data, key=lambda x: (x['para_index'], tuple(x['paragraph'])))]
+        outputs = []
+        for bucket_index in tqdm.trange(0, len(buckets), args.prefill_batch_size):
+            group = buckets[bucket_index:bucket_index + args.prefill_batch_size]
+            with inference_mode():
+                prefixes = [build_prefix_and_prompt(bucket[0], tokenizer)[0] for bucket in group]
+                input_ids, token_type_ids, paragraph_mask = pad_left(prefixes, pad, args.device)
+                position_ids = (paragraph_mask.cumsum(-1) - 1).clamp(min=0)
+                _, group_past = model(input_ids, token_type_ids=token_type_ids, position_ids=position_ids,
+                                      attention_mask=paragraph_mask)
+
+            for paragraph_index, bucket in enumerate(group):
+                if outputs and outputs[-1]['para_index'] != bucket[0]['para_index']:
+                    question_number = write_paragraph(f, outputs, tokenizer, question_number)
+                    outputs = []
+
+                with inference_mode():
+                    # Every question only feeds its answer prompt on top of the prefilled paragraph, whose left
+                    # padding is dropped: decoding attends to the real paragraph positions only
+                    paragraph_length = len(prefixes[paragraph_index]['input_ids'])
+                    past = [p[:, paragraph_index:paragraph_index + 1, :, -paragraph_length:] for p in group_past]
+
+                    for i in range(0, len(bucket), args.batch_size):
+                        outputs.extend(sample_sequence(bucket[i:i + args.batch_size], tokenizer, model, args, past,
+                                                       special_tokens_ids, pad, graphs))
+
+        if outputs:
+            write_paragraph(f, outputs, tokenizer, question_number)
+        f.write(']}]}')
+    os.replace(output_path + ".tmp", output_path)
 
 
 if __name__ == "__main__":
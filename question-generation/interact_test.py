@@ -0,0 +1,146 @@
+import copy
+import unittest
+from argparse import Namespace
+
+import torch
+import torch.nn.functional as F
+
+from pytorch_pretrained_bert import GPT2Config, GPT2LMHeadModel
+from train import SPECIAL_TOKENS
+from interact import build_prefix_and_prompt, filter_candidates, sample_next_tokens, sample_sequence
+
+VOCAB_SIZE = 99
+
+
+class StubTokenizer(object):
+    """ Special tokens come after the VOCAB_SIZE tokens of the vocabulary """
+
+    def convert_tokens_to_ids(self, tokens):
+        return [VOCAB_SIZE + SPECIAL_TOKENS.index(token) for token in tokens]
+
+
+def reference_filtering(logits, top_k=0, top_p=0.0):
+    """ Top-k and top-p filtering of a batch of logits with a sort of the whole vocabulary """
+    logits = logits.clone()
+    if top_k > 0:
+        logits[logits < torch.topk(logits, top_k)[0][..., -1:]] = -float('Inf')
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probabilities = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probabilities > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
+        logits[indices_to_remove] = -float('Inf')
+    return logits
+
+
+def scatter_candidates(logits, candidate_logits, candidate_indices):
+    """ Back to a (batch size, vocabulary size) tensor of logits, the tokens which are not candidates are removed """
+    return torch.full_like(logits, -float('Inf')).scatter(-1, candidate_indices, candidate_logits)
+
+
+class FilterCandidatesTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.logits = torch.randn(4, 50) * 3
+
+    def check_filtering(self, top_k=0, top_p=0.0, expected=None, **kwargs):
+        candidate_logits, candidate_indices = filter_candidates(self.logits, top_k=top_k, top_p=top_p, **kwargs)
+        # Candidates are sorted by decreasing logits
+        kept = candidate_logits > -float('Inf')
+        self.assertTrue((candidate_logits[:, 1:] <= candidate_logits[:, :-1]).masked_select(kept[:, 1:]).all())
+        filtered = scatter_candidates(self.logits, candidate_logits, candidate_indices)
+        if expected is None:
+            expected = reference_filtering(self.logits, top_k=top_k, top_p=top_p)
+        self.assertTrue(torch.equal(filtered, expected))
+
+    def test_top_k(self):
+        self.check_filtering(top_k=5)
+
+    def test_top_p(self):
+        self.check_filtering(top_p=0.9)
+
+    def test_top_k_then_top_p(self):
+        self.check_filtering(top_k=10, top_p=0.8)
+
+    def test_top_p_prefix_truncation(self):
+        # The 5 most likely tokens of a flat distribution do not reach top_p: the nucleus is truncated to them
+        self.logits = torch.randn(4, 50) * 0.1
+        self.check_filtering(top_p=0.99, top_p_prefix=5, expected=reference_filtering(self.logits, top_k=5))
+
+    def test_no_filtering(self):
+        candidate_logits, candidate_indices = filter_candidates(self.logits)
+        self.assertIs(candidate_logits, self.logits)
+        self.assertIsNone(candidate_indices)
+
+    def test_sampling_stays_in_candidates(self):
+        logits = self.logits.repeat(250, 1)
+        for top_k, top_p in [(5, 0.0), (0, 0.5), (10, 0.8)]:
+            args = Namespace(fused_sampling=False, top_k=top_k, top_p=top_p)
+            prev = sample_next_tokens(logits, args)
+            filtered = reference_filtering(logits, top_k=top_k, top_p=top_p)
+            self.assertTrue((filtered.gather(-1, prev) > -float('Inf')).all())
+
+
+class EndAtPosition(object):
+    """ Wrap a GPT2LMHeadModel to predict <eos> after the token at `end_position` and no special token otherwise """
+
+    def __init__(self, model, end_position, eos):
+        self.model = model
+        self.end_position = end_position
+        self.bias = torch.zeros(model.config.total_tokens_embeddings)
+        self.bias[VOCAB_SIZE:] = -1e4
+        self.eos_bias = torch.zeros(model.config.total_tokens_embeddings)
+        self.eos_bias[eos] = 2e4
+
+    def init_past(self, batch_size, max_length):
+        return self.model.init_past(batch_size, max_length)
+
+    def __call__(self, input_ids, token_type_ids=None, position_ids=None, past=None, attention_mask=None,
+                 past_length=None):
+        logits, presents = self.model(input_ids, token_type_ids=token_type_ids, position_ids=position_ids, past=past,
+                                      attention_mask=attention_mask, past_length=past_length)
+        end = (position_ids == self.end_position).unsqueeze(-1).float()
+        return logits + self.bias + end * self.eos_bias, presents
+
+
+class SampleSequenceTest(unittest.TestCase):
+
+    def test_batch_matches_single_instances(self):
+        torch.manual_seed(0)
+        config = GPT2Config(vocab_size_or_config_json_file=VOCAB_SIZE, n_special=len(SPECIAL_TOKENS), n_positions=64,
+                            n_embd=32, n_layer=2, n_head=4)
+        model = GPT2LMHeadModel(config)
+        model.eval()
+        tokenizer = StubTokenizer()
+        special_tokens_ids = tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
+        pad = special_tokens_ids[-1]
+
+        # A paragraph of 5 tokens (past of 6 positions with <bos>) and answer prompts of 10, 3 and 4 tokens.
+        # <eos> is forced after position 17: the first question ends after 2 tokens, the others after 9 and 8 tokens
+        # so that the first row is compacted away at the first check
+        paragraph = [1, 2, 3, 4, 5]
+        bucket = [{'paragraph': paragraph, 'answer': list(range(10, 18)), 'question': [], 'class': 'general'},
+                  {'paragraph': paragraph, 'answer': [20], 'question': [], 'class': 'specific'},
+                  {'paragraph': paragraph, 'answer': [30, 31], 'question': [], 'class': 'general'}]
+        model = EndAtPosition(model, 17, special_tokens_ids[1])
+        args = Namespace(device='cpu', max_length=20, min_length=1, temperature=1, no_sample=True, top_k=0,
+                         top_p=0.0, fused_sampling=False)
+
+        with torch.no_grad():
+            prefix, _ = build_prefix_and_prompt(bucket[0], tokenizer)
+            _, past = model(torch.tensor([prefix['input_ids']]), token_type_ids=torch.tensor([prefix['token_type_ids']]),
+                            position_ids=torch.arange(len(prefix['input_ids'])).unsqueeze(0))
+            special_tokens_ids = torch.tensor(special_tokens_ids)
+            batch = sample_sequence(copy.deepcopy(bucket), tokenizer, model, args, past, special_tokens_ids, pad)
+            singles = [sample_sequence([copy.deepcopy(inst)], tokenizer, model, args, past, special_tokens_ids, pad)[0]
+                       for inst in bucket]
+
+        self.assertListEqual([len(inst['question']) for inst in batch], [2, 9, 8])
+        self.assertListEqual([inst['question'] for inst in batch], [inst['question'] for inst in singles])
+
+
+if __name__ == "__main__":
+    unittest.main()
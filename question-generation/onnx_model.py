@@ -0,0 +1,131 @@
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__file__)
+
+NUMPY_TYPES = {torch.float32: np.float32, torch.float16: np.float16, torch.int64: np.int64}
+
+
+class ExportWrapper(torch.nn.Module):
+    """ Flatten the `past` inputs and `presents` outputs of a GPT2LMHeadModel for the ONNX export.
+        The keys/values are time-major ([length, 2, batch, head, head_features]) and only the keys/values of the new
+        positions are output, so that they can be written right after the past positions of the same buffer.
+    """
+
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, position_ids, attention_mask, *past):
+        past = [p.permute(1, 2, 3, 0, 4) for p in past]
+        logits, presents = self.model(input_ids, token_type_ids=token_type_ids, position_ids=position_ids,
+                                      past=past, attention_mask=attention_mask)
+        past_length = past[0].size(-2)
+        return (logits,) + tuple(p[:, :, :, past_length:].permute(3, 0, 1, 2, 4) for p in presents)
+
+
+def export_onnx(model, path, device):
+    """ Export a GPT2LMHeadModel to ONNX with the past keys/values of each layer as inputs (past_i) and the keys/values
+        of the new positions as outputs (present_i)
+    """
+    config = model.config
+    past_names = ['past_%d' % i for i in range(config.n_layer)]
+    present_names = ['present_%d' % i for i in range(config.n_layer)]
+    input_names = ['input_ids', 'token_type_ids', 'position_ids', 'attention_mask'] + past_names
+
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ['input_ids', 'token_type_ids', 'position_ids', 'logits']}
+    dynamic_axes['attention_mask'] = {0: 'batch', 1: 'total_sequence'}
+    dynamic_axes.update({name: {0: 'past_sequence', 2: 'batch'} for name in past_names})
+    dynamic_axes.update({name: {0: 'sequence', 2: 'batch'} for name in present_names})
+
+    # Dummy inputs of one sequence of 2 tokens on top of 1 past position
+    input_ids = torch.zeros(1, 2, dtype=torch.long, device=device)
+    position_ids = torch.tensor([[1, 2]], device=device)
+    attention_mask = torch.ones(1, 3, dtype=torch.long, device=device)
+    past = [time_major(p).zero_() for p in model.transformer.init_past(1, 1)]
+
+    with torch.no_grad():
+        # Opset 10 is the first one with dynamic slicing (the exporter of torch >= 1.2)
+        torch.onnx.export(ExportWrapper(model), (input_ids, input_ids.clone(), position_ids, attention_mask) + tuple(past),
+                          path, input_names=input_names, output_names=['logits'] + present_names,
+                          dynamic_axes=dynamic_axes, opset_version=10)
+    logger.info("Model exported to ONNX at %s", path)
+
+
+def time_major(buffer):
+    """ View a `past` buffer [2, batch, head, length, head_features] as [length, 2, batch, head, head_features] """
+    return buffer.permute(3, 0, 1, 2, 4)
+
+
+def bind_tensor(binding, name, tensor, output=False):
+    """ Bind a contiguous torch tensor to an ONNX Runtime input/output without copying it """
+    kwargs = dict(name=name, device_type=tensor.device.type, device_id=tensor.device.index or 0,
+                  element_type=NUMPY_TYPES[tensor.dtype], shape=tuple(tensor.size()), buffer_ptr=tensor.data_ptr())
+    if output:
+        binding.bind_output(**kwargs)
+    else:
+        binding.bind_input(**kwargs)
+
+
+class OnnxGPT2LMHeadModel(object):
+    """ Run a GPT2LMHeadModel exported with `export_onnx` on ONNX Runtime.
+        It is called like the PyTorch model for decoding (including preallocated `past` buffers with `past_length`).
+        Inputs and outputs are torch tensors bound with IO binding, they stay on the device.
+        The `past` buffers of `init_past` are time-major in memory: their filled positions and the new positions are
+        both contiguous, they are bound as the past inputs and the present outputs of the graph so that the new
+        keys/values are written in place, without copying the cache.
+    """
+
+    def __init__(self, path, config, device, dtype=torch.float32):
+        import onnxruntime  # ONNX Runtime is only required to decode with an ONNX export of the model
+        providers = ['CUDAExecutionProvider'] if torch.device(device).type == 'cuda' else []
+        self.session = onnxruntime.InferenceSession(path, providers=providers + ['CPUExecutionProvider'])
+        self.config = config
+        self.device = device
+        self.dtype = dtype
+        self.logits_size = config.total_tokens_embeddings if config.predict_special_tokens else config.vocab_size
+
+    def init_past(self, batch_size, max_length):
+        """ Allocate an empty `past` for up to max_length positions (cf. `GPT2Model.init_past`), time-major in memory """
+        head_features = self.config.n_embd // self.config.n_head
+        return [torch.empty(max_length, 2, batch_size, self.config.n_head, head_features, dtype=self.dtype,
+                            device=self.device).permute(1, 2, 3, 0, 4) for _ in range(self.config.n_layer)]
+
+    def __call__(self, input_ids, token_type_ids, position_ids, past=None, attention_mask=None, past_length=None):
+        """ Returns the logits and the `past` buffers holding the new keys/values. They are the input `past` buffers
+            unless these could not be written in place (no `past_length`, or buffers which are not time-major like
+            the result of an index_select): the caller must then use the returned ones.
+        """
+        batch_size, sequence_length = input_ids.size()
+        if past is None:
+            past, past_length = self.init_past(batch_size, sequence_length), 0
+        elif past_length is None or not time_major(past[0]).is_contiguous():
+            # Copy the past in new time-major buffers (a concatenated past, or the result of an index_select)
+            if past_length is None:
+                past_length, max_length = past[0].size(-2), past[0].size(-2) + sequence_length
+            else:
+                max_length = past[0].size(-2)
+            buffers = self.init_past(batch_size, max_length)
+            for buffer, p in zip(buffers, past):
+                buffer[:, :, :, :past_length] = p[:, :, :, :past_length]
+            past = buffers
+        total_length = past_length + sequence_length
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(batch_size, total_length)
+
+        inputs = [x.contiguous() for x in [input_ids, token_type_ids, position_ids, attention_mask]]
+        inputs += [time_major(p)[:past_length] for p in past]
+        logits = past[0].new_empty(batch_size, sequence_length, self.logits_size)
+        outputs = [logits] + [time_major(p)[past_length:total_length] for p in past]
+
+        binding = self.session.io_binding()
+        for session_input, tensor in zip(self.session.get_inputs(), inputs):
+            bind_tensor(binding, session_input.name, tensor)
+        for session_output, tensor in zip(self.session.get_outputs(), outputs):
+            bind_tensor(binding, session_output.name, tensor, output=True)
+        binding.synchronize_inputs()
+        self.session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return logits, past
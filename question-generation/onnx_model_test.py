@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import GPT2Config, GPT2LMHeadModel
+from onnx_model import OnnxGPT2LMHeadModel, export_onnx
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+@unittest.skipIf(onnxruntime is None, "ONNX Runtime is not installed")
+class OnnxGPT2LMHeadModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_logits_match_pytorch(self):
+        config = GPT2Config(vocab_size_or_config_json_file=99, n_special=2, n_positions=33, n_embd=32, n_layer=2, n_head=4)
+        model = GPT2LMHeadModel(config)
+        model.eval()
+        path = os.path.join(self.tmp_dir, "model.onnx")
+        export_onnx(model, path, "cpu")
+        onnx_model = OnnxGPT2LMHeadModel(path, config, "cpu")
+
+        # Left padded prefill, then one decoding step in a preallocated past
+        input_ids = torch.randint(0, 99, (2, 5))
+        attention_mask = torch.tensor([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]])
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        next_ids = torch.randint(0, 99, (2, 1))
+        next_position_ids = position_ids[:, -1:] + 1
+        next_mask = torch.cat((attention_mask, torch.ones(2, 1, dtype=torch.long)), dim=-1)
+
+        with torch.no_grad():
+            logits, presents = model(input_ids, token_type_ids=input_ids, position_ids=position_ids,
+                                     attention_mask=attention_mask)
+            next_logits, _ = model(next_ids, token_type_ids=next_ids, position_ids=next_position_ids, past=presents,
+                                   attention_mask=next_mask)
+
+        onnx_logits, onnx_presents = onnx_model(input_ids, input_ids, position_ids, attention_mask=attention_mask)
+        self.assertTrue(torch.allclose(logits, onnx_logits, atol=1e-4))
+        past = onnx_model.init_past(2, 7)
+        for buffer, present in zip(past, onnx_presents):
+            buffer[:, :, :, :5] = present
+        onnx_next_logits, onnx_past = onnx_model(next_ids, next_ids, next_position_ids, past=past,
+                                                 attention_mask=next_mask, past_length=5)
+        self.assertTrue(torch.allclose(next_logits, onnx_next_logits, atol=1e-4))
+        # The new keys/values are written in place in the time-major buffers
+        self.assertIs(onnx_past[0], past[0])
+        self.assertTrue(torch.allclose(presents[0], past[0][:, :, :, :5], atol=1e-4))
+
+        # A compacted batch (index_select) is copied back to time-major buffers
+        keep = torch.tensor([1])
+        past = [p.index_select(1, keep) for p in past]
+        second_mask = torch.ones(1, 7, dtype=torch.long)
+        with torch.no_grad():
+            second_logits, _ = model(next_ids[keep], token_type_ids=next_ids[keep], past=[p[:, :, :, :6] for p in past],
+                                     position_ids=next_position_ids[keep] + 1, attention_mask=second_mask)
+        onnx_second_logits, _ = onnx_model(next_ids[keep], next_ids[keep], next_position_ids[keep] + 1, past=past,
+                                           attention_mask=second_mask, past_length=6)
+        self.assertTrue(torch.allclose(second_logits, onnx_second_logits, atol=1e-4))
+
+if __name__ == "__main__":
+    unittest.main()